@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """agent@example.com の新着メールをチェック
 - 要対応メール（VIP送信者/オーナー）→ OpenClawセッションを起動してエージェントが自律処理
-- その他 → Telegram通知のみ
+- その他 → Telegram通知のみ（一括配信メールはダイジェストにまとめる）
 
 セキュリティ対策:
 - ロックファイルによる重複実行防止（冪等性）
@@ -11,18 +11,37 @@
 - エラーハンドリング＋Telegram通知
 - 添付ファイルサイズ・タイプ制限
 - 構造化監査ログ（JSON Lines）
+- ヘッダ先読みによる優先度レーン（VIPメールをバックログより先に処理）
+- 一括配信メールのヘッダ判定とダイジェスト通知
+- 処理済みメールの全文検索インデックス（SQLite FTS5、`search` サブコマンド）
+- 処理済みメールを月別フォルダへ一括アーカイブ（UID MOVE / COPY+EXPUNGE）
+- 監査ログの差分集計（`stats` サブコマンド）
+- 失敗した system event / Telegram通知の永続再送キュー（指数バックオフ、dead letter）
+- Message-ID / ヘッダ指紋による実行をまたいだ重複メール除外
+- 取得・解析・添付保存・通知のパイプライン並行実行
 """
 
-import imaplib, email, json, os, sys, time, subprocess, re, fcntl
+import imaplib, email, json, os, sys, time, subprocess, re, fcntl, sqlite3, argparse
+import random, threading, uuid, hashlib, math, struct, queue, html
+from collections import deque
 from email.header import decode_header
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 
 MAIL_CONFIG = Path(os.path.expanduser("~/.config/mail/akiko.json"))
 STATE_FILE = Path(os.path.expanduser("~/.config/mail/last_seen_uid.txt"))
+COMPLETED_UIDS_FILE = Path(os.path.expanduser("~/.config/mail/completed_uids.txt"))
 UIDVALIDITY_FILE = Path(os.path.expanduser("~/.config/mail/uidvalidity.txt"))
 LOCK_FILE = Path(os.path.expanduser("~/.config/mail/check_mail.lock"))
+OUTBOX_DIR = Path(os.path.expanduser("~/.config/mail/outbox"))
+OUTBOX_LOCK_FILE = Path(os.path.expanduser("~/.config/mail/outbox.lock"))
+DEDUP_FILE = Path(os.path.expanduser("~/.config/mail/dedup.bin"))
 AUDIT_LOG = Path(os.path.expanduser("~/logs/mail_audit.jsonl"))
+AUDIT_STATS_FILE = Path(os.path.expanduser("~/.config/mail/audit_stats.json"))
+SENDER_STATS_FILE = Path(os.path.expanduser("~/.config/mail/sender_stats.json"))
+BULK_DIGEST_FILE = Path(os.path.expanduser("~/.config/mail/bulk_digest.json"))
+MAIL_INDEX_DB = Path(os.path.expanduser("~/.config/mail/mail_index.sqlite3"))
 OPENCLAW_BIN = os.path.expanduser("~/.nvm/versions/node/v24.14.0/bin/openclaw")
 OPENCLAW_CONFIG = Path(os.path.expanduser("~/.openclaw/openclaw.json"))
 TMP_DIR = Path(os.path.expanduser("~/workspace/assets/tmp"))
@@ -50,6 +69,35 @@ ALLOWED_ATTACHMENT_TYPES = {
 # 受信サーバーのホスト名（Authentication-Results の信頼チェーン）
 TRUSTED_AUTH_SERVER = ""  # 例: "mx.example.com"
 
+# 一括配信メール（メルマガ・自動通知）はヘッダで判定し、ダイジェスト1通にまとめる
+BULK_PRECEDENCE = {"bulk", "list", "junk"}
+BULK_SENDER_MIN_SAMPLES = 3   # 評判判定に必要な最低受信数
+BULK_SENDER_RATIO = 0.8       # 受信のうちこの割合以上が一括配信の送信者はヘッダなしでも一括扱い
+BULK_DIGEST_INTERVAL = 0      # ダイジェスト送信間隔（秒）。0 = 実行ごとに送信
+BULK_DIGEST_MAX_ITEMS = 30    # ダイジェストに列挙する最大件数
+
+# 処理済みメールの移動先（処理結果ごと）。None = INBOXに残す
+# {month} は処理月（例: Archive/2026-10）。階層区切りが "." のサーバーでは "INBOX.Archive.{month}" 等にする
+ARCHIVE_FOLDERS = {
+    "auth_blocked": None,                 # 要手動確認なのでINBOXに残す
+    "auto_process": "Archive/{month}",
+    "auto_process_failed": None,          # 要手動対応なのでINBOXに残す
+    "notify": "Archive/{month}",
+    "digest": "Archive/{month}",
+    "duplicate": None,                    # UIDVALIDITYリセット後はINBOXに残した原本もここに該当する
+}
+
+# 重複メール判定（Message-ID / ヘッダ指紋）
+DEDUP_RECENT_WINDOW = 5000        # 直近この件数は完全一致で判定
+DEDUP_BLOOM_CAPACITY = 100000     # Bloomフィルタ1世代あたりの件数（超えたら世代交代）
+DEDUP_BLOOM_FP_RATE = 1e-6        # Bloomフィルタの偽陽性率
+
+# 失敗した system event / Telegram通知の再送（指数バックオフ + ジッタ）
+RETRY_BASE_DELAY = 60          # 1回目の再送までの基準秒数（以降2倍ずつ）
+RETRY_MAX_DELAY = 3600         # 再送間隔の上限（秒）
+RETRY_MAX_ATTEMPTS = 8         # これを超えたら dead letter
+OUTBOX_DRAIN_BUDGET = 30       # 1回の再送処理に使う最大秒数
+
 JST = timezone(timedelta(hours=9))
 
 
@@ -68,6 +116,137 @@ def audit_log(event, **kwargs):
         f.write(json.dumps(entry, ensure_ascii=False) + "\n")
 
 
+# ─────────────────────────────────────────────
+# 監査ログ集計（バイトオフセットのチェックポイントで差分のみ集計）
+# ─────────────────────────────────────────────
+# system event の所要時間ヒストグラムの上限値（ミリ秒）
+WAKE_LATENCY_BUCKETS_MS = [500, 1000, 2000, 5000, 10000, 15000]
+
+
+def empty_audit_rollups():
+    return {
+        "events": {},           # {event: 件数}
+        "days": {},             # {YYYY-MM-DD: {event: 件数}}
+        "senders": {},          # {YYYY-MM: {sender: {event: 件数}}}
+        "block_reasons": {},    # {理由: 件数}
+        "wake": {"success": 0, "failure": 0},
+        "wake_latency_ms": {},  # {"<=500": 件数, ..., ">15000": 件数}
+    }
+
+
+def _count(d, key, n=1):
+    d[key] = d.get(key, 0) + n
+
+
+def _latency_bucket(ms):
+    for limit in WAKE_LATENCY_BUCKETS_MS:
+        if ms <= limit:
+            return f"<={limit}"
+    return f">{WAKE_LATENCY_BUCKETS_MS[-1]}"
+
+
+def fold_audit_entry(rollups, entry):
+    """監査ログ1行分を集計に加算"""
+    event = entry.get("event", "unknown")
+    timestamp = entry.get("timestamp", "")
+    day, month = timestamp[:10], timestamp[:7]
+
+    _count(rollups["events"], event)
+    if day:
+        _count(rollups["days"].setdefault(day, {}), event)
+    sender = entry.get("sender")
+    if sender and month:
+        _count(rollups["senders"].setdefault(month, {}).setdefault(sender, {}), event)
+
+    if event == "mail_blocked":
+        # 認証ヘッダの中身は除いて理由の種類だけで数える
+        reason = re.split(r"[:：（]| \(", entry.get("reason", ""))[0].strip()
+        _count(rollups["block_reasons"], reason[:80] or "unknown")
+    elif event == "mail_processed" and entry.get("action") == "system_event":
+        _count(rollups["wake"], "success" if entry.get("success") else "failure")
+        if "latency_ms" in entry:
+            _count(rollups["wake_latency_ms"], _latency_bucket(entry["latency_ms"]))
+
+
+def load_audit_stats():
+    if AUDIT_STATS_FILE.exists():
+        try:
+            return json.loads(AUDIT_STATS_FILE.read_text())
+        except (OSError, ValueError):
+            pass
+    return {"inode": None, "offset": 0, "rollups": empty_audit_rollups()}
+
+
+def save_audit_stats(stats):
+    AUDIT_STATS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = AUDIT_STATS_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(stats, ensure_ascii=False))
+    os.replace(tmp, AUDIT_STATS_FILE)
+
+
+def update_audit_stats():
+    """前回のオフセット以降に追記された行だけを集計に畳み込む
+
+    ログがローテート（inode変化）または切り詰められた場合は先頭から読み直す。
+    書き込み途中の最終行は次回に回す。
+
+    Returns:
+        dict: 更新後の集計
+    """
+    stats = load_audit_stats()
+    if not AUDIT_LOG.exists():
+        return stats["rollups"]
+
+    st = AUDIT_LOG.stat()
+    if stats["inode"] != st.st_ino or st.st_size < stats["offset"]:
+        stats["inode"], stats["offset"] = st.st_ino, 0
+
+    with open(AUDIT_LOG, "rb") as f:
+        f.seek(stats["offset"])
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            stats["offset"] += len(line)
+            try:
+                fold_audit_entry(stats["rollups"], json.loads(line))
+            except ValueError:
+                continue
+
+    save_audit_stats(stats)
+    return stats["rollups"]
+
+
+def format_audit_report(rollups, month=None, top=10):
+    """集計から監査レポートを作る（ログサイズに依存しない）"""
+    month = month or datetime.now(JST).strftime("%Y-%m")
+    lines = ["== イベント別件数 =="]
+    for event, n in sorted(rollups["events"].items(), key=lambda kv: -kv[1]):
+        lines.append(f"  {event}: {n}")
+
+    wake = rollups["wake"]
+    total = wake["success"] + wake["failure"]
+    rate = f"{wake['success'] / total:.1%}" if total else "-"
+    lines.append(f"\n== 自動処理（system event）成功率: {rate} ({wake['success']}/{total}) ==")
+    buckets = [f"<={b}" for b in WAKE_LATENCY_BUCKETS_MS] + [f">{WAKE_LATENCY_BUCKETS_MS[-1]}"]
+    for bucket in buckets:
+        n = rollups["wake_latency_ms"].get(bucket, 0)
+        if n:
+            lines.append(f"  {bucket:>8}ms: {n}")
+
+    lines.append("\n== ブロック理由 ==")
+    for reason, n in sorted(rollups["block_reasons"].items(), key=lambda kv: -kv[1]):
+        lines.append(f"  {reason}: {n}")
+
+    senders = rollups["senders"].get(month, {})
+    lines.append(f"\n== 送信者別（{month}、上位{top}） ==")
+    ranked = sorted(senders.items(),
+                    key=lambda kv: (-kv[1].get("mail_blocked", 0), -kv[1].get("mail_received", 0)))
+    for sender, events in ranked[:top]:
+        lines.append(f"  {sender}: received={events.get('mail_received', 0)} "
+                     f"blocked={events.get('mail_blocked', 0)}")
+    return "\n".join(lines)
+
+
 # ─────────────────────────────────────────────
 # ロックファイル（冪等性: cron重複実行防止）
 # ─────────────────────────────────────────────
@@ -104,17 +283,37 @@ class FileLock:
 # ─────────────────────────────────────────────
 # 通知
 # ─────────────────────────────────────────────
+# 送信結果: 成功 / 一時的な失敗（再送する）/ 恒久的な失敗（再送しても無駄）
+SEND_OK = "ok"
+SEND_RETRY = "retry"
+SEND_PERMANENT = "permanent"
+
+
 def telegram_notify(text):
-    """Telegram にテキスト通知を送る"""
+    """Telegram にテキスト通知を送る（失敗時は再送キューへ）"""
+    status = send_telegram(text)
+    if status != SEND_OK:
+        enqueue_outbound("telegram", text, status=status)
+
+
+def send_telegram(text):
+    """Telegram にテキスト通知を1回だけ送る
+
+    429 以外の 4xx（HTMLの構文エラー、chat_id 不正など）は恒久的な失敗とする。
+
+    Returns:
+        str: SEND_OK / SEND_RETRY / SEND_PERMANENT
+    """
     try:
         config = json.load(open(OPENCLAW_CONFIG))
         bot_token = config["channels"]["telegram"]["botToken"]
     except Exception as e:
         print(f"Telegram token error: {e}")
-        return
-    import urllib.request, urllib.parse
+        return SEND_RETRY
+    import urllib.request, urllib.parse, urllib.error
     url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    clean_text = text.replace("&", "&amp;")
+    # 素の & だけをエスケープ（html.escape 済みの &lt; 等は二重にしない）
+    clean_text = re.sub(r"&(?!(?:amp|lt|gt|quot|#\d+);)", "&amp;", text)
     params = urllib.parse.urlencode({
         "chat_id": TELEGRAM_CHAT_ID,
         "text": clean_text,
@@ -122,8 +321,15 @@ def telegram_notify(text):
     }).encode()
     try:
         urllib.request.urlopen(urllib.request.Request(url, data=params), timeout=10)
+        return SEND_OK
+    except urllib.error.HTTPError as e:
+        print(f"Telegram notify failed: {e}")
+        if 400 <= e.code < 500 and e.code != 429:
+            return SEND_PERMANENT
+        return SEND_RETRY
     except Exception as e:
         print(f"Telegram notify failed: {e}")
+        return SEND_RETRY
 
 
 def telegram_error(error_msg):
@@ -159,15 +365,145 @@ def wake_akiko(task_message):
         return False
 
 
+# ─────────────────────────────────────────────
+# 再送キュー（アウトボックス）
+# ─────────────────────────────────────────────
+# 1ジョブ = OUTBOX_DIR 内の JSON 1ファイル。書き込みは tmp + rename で原子的に行う。
+# 再送上限に達したジョブは OUTBOX_DIR/dead/ に移す。
+def retry_delay(attempts):
+    """attempts 回失敗した後の待ち時間（指数バックオフ、後半半分をジッタ）"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _write_job(path, job):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(job, ensure_ascii=False))
+    os.replace(tmp, path)
+
+
+def enqueue_outbound(kind, text, status=SEND_RETRY, **meta):
+    """送信に失敗した system event / Telegram通知を再送キューに積む
+
+    呼び出し側で1回目の送信に失敗している前提で attempts=1 から始める。
+    status が SEND_PERMANENT なら再送せず即 dead letter にする。
+    """
+    now = time.time()
+    job = {
+        "id": f"{int(now * 1000)}-{uuid.uuid4().hex[:8]}",
+        "kind": kind,
+        "text": text,
+        "meta": meta,
+        "attempts": 1,
+        "created": now,
+        "next_attempt": now + retry_delay(1),
+    }
+    try:
+        OUTBOX_DIR.mkdir(parents=True, exist_ok=True)
+        if status == SEND_PERMANENT:
+            _dead_letter(None, job, reason="permanent")
+            return
+        _write_job(OUTBOX_DIR / f"{job['id']}.json", job)
+    except OSError as e:
+        print(f"  ⚠️ 再送キューへの書き込み失敗: {e}")
+        return
+    print(f"  → Queued {kind} for retry")
+    audit_log("outbound_queued", job=job["id"], kind=kind, **meta)
+
+
+def _deliver(job):
+    """ジョブを1回送信（Returns: SEND_OK / SEND_RETRY / SEND_PERMANENT）"""
+    if job["kind"] == "system_event":
+        return SEND_OK if wake_akiko(job["text"]) else SEND_RETRY
+    return send_telegram(job["text"])
+
+
+def _dead_letter(path, job, reason="max_attempts"):
+    dead_dir = OUTBOX_DIR / "dead"
+    dead_dir.mkdir(parents=True, exist_ok=True)
+    _write_job(dead_dir / f"{job['id']}.json", job)
+    if path is not None:
+        path.unlink()
+    print(f"  ⚠️ {job['kind']} を dead letter に移動 ({reason})")
+    audit_log("outbound_dead_letter", job=job["id"], kind=job["kind"],
+              attempts=job["attempts"], reason=reason, **job["meta"])
+    if job["kind"] == "system_event":
+        # ここで初めて手動対応を依頼する（再送キューには戻さない）
+        send_telegram(
+            f"📧 <b>⚡ 自動処理の再送が上限に達しました</b>\n"
+            f"Subject: {job['meta'].get('subject', '')}\n"
+            f"試行回数: {job['attempts']}\n\n"
+            f"⚠️ 手動で対応してください。"
+        )
+
+
+def drain_outbox(budget=OUTBOX_DRAIN_BUDGET, now=None):
+    """期限の来たジョブを古い順に再送する
+
+    別プロセスが再送中なら何もしない。budget 秒を超えたら残りは次回に回す。
+
+    Returns:
+        int: 再送に成功した件数
+    """
+    if not OUTBOX_DIR.exists():
+        return 0
+    lock = FileLock(OUTBOX_LOCK_FILE)
+    if not lock.acquire():
+        return 0
+    delivered = 0
+    started = time.monotonic()
+    try:
+        for path in sorted(OUTBOX_DIR.glob("*.json")):
+            if time.monotonic() - started > budget:
+                break
+            try:
+                job = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            if job["next_attempt"] > (now or time.time()):
+                continue
+
+            status = _deliver(job)
+            if status == SEND_OK:
+                path.unlink()
+                delivered += 1
+                audit_log("outbound_delivered", job=job["id"], kind=job["kind"],
+                          attempts=job["attempts"] + 1, **job["meta"])
+                continue
+
+            job["attempts"] += 1
+            if status == SEND_PERMANENT:
+                _dead_letter(path, job, reason="permanent")
+            elif job["attempts"] >= RETRY_MAX_ATTEMPTS:
+                _dead_letter(path, job)
+            else:
+                job["next_attempt"] = time.time() + retry_delay(job["attempts"])
+                _write_job(path, job)
+    finally:
+        lock.release()
+    return delivered
+
+
 # ─────────────────────────────────────────────
 # メールパーサ
 # ─────────────────────────────────────────────
+def _decode_bytes(data, charset):
+    """不正なバイト列・未知の文字コードでも例外を出さずにデコード"""
+    try:
+        return data.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
+
+
 def decode_header_value(value):
     if value is None:
         return ""
-    parts = decode_header(value)
+    try:
+        parts = decode_header(value)
+    except Exception:
+        return str(value)
     return "".join([
-        s.decode(e or "utf-8") if isinstance(s, bytes) else s
+        _decode_bytes(s, e) if isinstance(s, bytes) else s
         for s, e in parts
     ])
 
@@ -338,6 +674,760 @@ def save_last_seen_uid(uid):
     STATE_FILE.write_text(str(uid))
 
 
+def get_completed_uids():
+    """last_seen_uid より上で処理済みのUID（優先レーンで先に終わったもの）"""
+    if COMPLETED_UIDS_FILE.exists():
+        try:
+            return {int(u) for u in COMPLETED_UIDS_FILE.read_text().split()}
+        except (OSError, ValueError):
+            pass
+    return set()
+
+
+def save_completed_uids(uids):
+    COMPLETED_UIDS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    COMPLETED_UIDS_FILE.write_text(" ".join(str(u) for u in sorted(uids)))
+
+
+# ─────────────────────────────────────────────
+# 処理レーン（優先度スケジューリング）
+# ─────────────────────────────────────────────
+# 新着UIDをヘッダだけで先に分類し、値の小さいレーンから処理する。
+# バックログが何百通あってもVIPメールはその後ろに並ばない。
+LANE_AUTH_BLOCKED = 0   # 認証失敗アラート（本文は取得しない）
+LANE_AUTO_PROCESS = 1   # VIP送信者/オーナー → エージェント起動
+LANE_NOTIFY = 2         # その他 → Telegram通知のみ（本文プレビュー付き）
+LANE_DIGEST = 3         # 一括配信メール → ダイジェストにまとめる（本文は取得しない）
+
+# ヘッダ一括取得時の1コマンドあたりのUID数
+HEADER_FETCH_BATCH = 200
+
+
+def uid_ranges(uids):
+    """UIDリストをIMAPのシーケンスセットに圧縮（例: [1,2,3,7] → "1:3,7"）"""
+    nums = sorted({int(u) for u in uids})
+    ranges = []
+    start = prev = None
+    for n in nums + [None]:
+        if start is not None and n == prev + 1:
+            prev = n
+            continue
+        if start is not None:
+            ranges.append(str(start) if start == prev else f"{start}:{prev}")
+        start = prev = n
+    return ",".join(ranges)
+
+
+def fetch_headers(m, uids):
+    """新着UIDのヘッダだけを一括取得（本文・添付はダウンロードしない）
+
+    BODY.PEEK を使うので \\Seen フラグも立たない。
+
+    Returns:
+        dict: {uid(bytes): email.message.Message}
+    """
+    headers = {}
+    for i in range(0, len(uids), HEADER_FETCH_BATCH):
+        batch = uids[i:i + HEADER_FETCH_BATCH]
+        status, data = m.uid("fetch", uid_ranges(batch), "(BODY.PEEK[HEADER])")
+        if status != "OK":
+            continue
+        for item in data:
+            if not isinstance(item, tuple):
+                continue
+            match = re.search(rb'UID (\d+)', item[0])
+            if match:
+                headers[match.group(1)] = email.message_from_bytes(item[1])
+    return headers
+
+
+def fetch_message(m, uid):
+    """RFC822全体を取得（取得失敗時は None）"""
+    status, msg_data = m.uid("fetch", uid, "(RFC822)")
+    if status != "OK" or not msg_data or not isinstance(msg_data[0], tuple):
+        return None
+    return email.message_from_bytes(msg_data[0][1])
+
+
+def detect_bulk_mail(msg, sender_stats=None):
+    """ヘッダだけで一括配信メールかを判定
+
+    Returns:
+        str | None: 判定理由（一括配信でなければ None）
+    """
+    if msg["List-Id"] or msg["List-Unsubscribe"]:
+        return "list"
+    if (msg["Precedence"] or "").strip().lower() in BULK_PRECEDENCE:
+        return "precedence"
+    auto_submitted = (msg["Auto-Submitted"] or "").strip().lower()
+    if auto_submitted == "auto-replied":
+        return "auto-replied"
+    if auto_submitted and auto_submitted != "no":
+        return "auto-submitted"
+    if sender_stats:
+        sender_email = extract_sender_email(decode_header_value(msg["From"]))
+        entry = sender_stats.get(sender_email, {})
+        total = entry.get("total", 0)
+        if (total >= BULK_SENDER_MIN_SAMPLES
+                and entry.get("bulk", 0) / total >= BULK_SENDER_RATIO):
+            return "reputation"
+    return None
+
+
+def classify_mail(msg, sender_stats=None):
+    """ヘッダだけで処理レーンを決定
+
+    Returns:
+        (int, str): (レーン, 認証詳細 or 一括配信の判定理由)
+    """
+    sender_email = extract_sender_email(decode_header_value(msg["From"]))
+    if sender_email not in AUTO_PROCESS_SENDERS:
+        bulk_reason = detect_bulk_mail(msg, sender_stats)
+        if bulk_reason:
+            return LANE_DIGEST, bulk_reason
+        return LANE_NOTIFY, ""
+    auth_ok, auth_detail = verify_email_auth(msg, sender_email)
+    if not auth_ok:
+        return LANE_AUTH_BLOCKED, auth_detail
+    return LANE_AUTO_PROCESS, auth_detail
+
+
+def load_sender_stats():
+    """送信者ごとの受信数・一括配信判定数を読み込む"""
+    if SENDER_STATS_FILE.exists():
+        try:
+            return json.loads(SENDER_STATS_FILE.read_text())
+        except (OSError, ValueError):
+            pass
+    return {}
+
+
+def save_sender_stats(stats):
+    SENDER_STATS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    SENDER_STATS_FILE.write_text(json.dumps(stats, ensure_ascii=False))
+
+
+def record_sender(stats, sender_email, bulk_reason):
+    """送信者の評判カウントを更新
+
+    評判だけで判定したものは数えない（自己強化しないように）。
+    自動返信（不在通知など）は普段やり取りする相手からも届くので一括配信に数えない。
+    """
+    if bulk_reason == "reputation":
+        return
+    entry = stats.setdefault(sender_email, {"total": 0, "bulk": 0})
+    entry["total"] += 1
+    if bulk_reason and bulk_reason != "auto-replied":
+        entry["bulk"] += 1
+
+
+# この結果で処理し終えたメールだけ処理済みとして記録する
+# （認証失敗・起動失敗のコピーで、後から届く正規のコピーを抑止しない）
+DEDUP_OUTCOMES = ("auto_process", "notify", "digest")
+
+
+def dedup_key(msg):
+    """重複判定キー: Message-ID、なければ正規化したヘッダの指紋
+
+    本文を取得する前に判定できるよう、ヘッダだけから作る。
+    """
+    message_id = (msg["Message-ID"] or "").strip().strip("<>").lower()
+    if message_id:
+        return f"mid:{message_id}"
+    sender = extract_sender_email(decode_header_value(msg["From"]))
+    recipient = " ".join(decode_header_value(msg["To"]).lower().split())
+    subject = " ".join(decode_header_value(msg["Subject"]).split())
+    date = msg["Date"] or ""
+    try:
+        date = parsedate_to_datetime(date).astimezone(timezone.utc).isoformat()
+    except (TypeError, ValueError):
+        date = date.strip()
+    return "fp:" + "\x1f".join([sender, recipient, subject, date])
+
+
+class DedupFilter:
+    """実行をまたいだ重複メール判定（回転Bloomフィルタ + 直近の完全一致集合）
+
+    直近 DEDUP_RECENT_WINDOW 件は完全一致で、それより古いものは2世代の
+    Bloomフィルタで判定する。判定はO(1)、メモリとファイルサイズは
+    受信件数によらず一定（1世代が満杯になると古い世代を捨てる）。
+    """
+    MAGIC = b"DDF1"
+    HEADER = struct.Struct("<4sIIII")  # magic, nbits, k, count, recent件数
+
+    def __init__(self):
+        nbits = int(-DEDUP_BLOOM_CAPACITY * math.log(DEDUP_BLOOM_FP_RATE) / math.log(2) ** 2)
+        self.nbits = nbits + (-nbits % 8)
+        self.k = max(1, round(self.nbits / DEDUP_BLOOM_CAPACITY * math.log(2)))
+        self.current = bytearray(self.nbits // 8)
+        self.previous = bytearray(self.nbits // 8)
+        self.count = 0
+        self.recent = deque()
+        self.recent_set = set()
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha256(key.encode()).digest()[:16]
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.k)]
+
+    @staticmethod
+    def _has(bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def __contains__(self, key):
+        digest = self._digest(key)
+        if digest in self.recent_set:
+            return True
+        positions = self._positions(digest)
+        return self._has(self.current, positions) or self._has(self.previous, positions)
+
+    def add(self, key):
+        digest = self._digest(key)
+        if digest in self.recent_set:
+            return
+        self.recent.append(digest)
+        self.recent_set.add(digest)
+        if len(self.recent) > DEDUP_RECENT_WINDOW:
+            self.recent_set.discard(self.recent.popleft())
+
+        if self.count >= DEDUP_BLOOM_CAPACITY:
+            self.previous, self.current = self.current, bytearray(self.nbits // 8)
+            self.count = 0
+        for p in self._positions(digest):
+            self.current[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    @classmethod
+    def load(cls, path):
+        """保存済みのフィルタを読み込む（なし/設定変更時は空から）"""
+        f = cls()
+        try:
+            data = path.read_bytes()
+            magic, nbits, k, count, n_recent = cls.HEADER.unpack_from(data)
+        except (OSError, struct.error):
+            return f
+        nbytes = nbits // 8
+        if magic != cls.MAGIC or nbits != f.nbits or k != f.k:
+            return f
+        pos = cls.HEADER.size
+        recent = [data[pos + i * 16:pos + (i + 1) * 16] for i in range(n_recent)]
+        pos += n_recent * 16
+        f.current = bytearray(data[pos:pos + nbytes])
+        f.previous = bytearray(data[pos + nbytes:pos + 2 * nbytes])
+        if len(f.current) != nbytes or len(f.previous) != nbytes:
+            return cls()
+        f.count = count
+        f.recent = deque(recent[-DEDUP_RECENT_WINDOW:])
+        f.recent_set = set(f.recent)
+        return f
+
+    def save(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as out:
+            out.write(self.HEADER.pack(self.MAGIC, self.nbits, self.k,
+                                       self.count, len(self.recent)))
+            out.write(b"".join(self.recent))
+            out.write(self.current)
+            out.write(self.previous)
+        os.replace(tmp, path)
+
+
+class UidWatermark:
+    """順不同で完了するUIDから last_seen_uid を安全に進める
+
+    未完了UIDより手前までしか進めないため、途中で落ちても未処理メールを
+    取りこぼさない。それより上の完了済みUIDは done に残るので、呼び出し側で
+    last_seen_uid と一緒に保存し、次回は再処理しない。
+    """
+    def __init__(self, uids):
+        self.pending = deque(sorted(int(u) for u in uids))
+        self.done = set()
+        self.mark = 0
+
+    def complete(self, uid):
+        """UIDを完了扱いにする。last_seen_uid が進んだ場合は新しい値を返す"""
+        self.done.add(int(uid))
+        advanced = False
+        while self.pending and self.pending[0] in self.done:
+            self.mark = self.pending.popleft()
+            self.done.discard(self.mark)
+            advanced = True
+        return self.mark if advanced else None
+
+
+# ─────────────────────────────────────────────
+# 処理済みメールの全文検索インデックス（SQLite FTS5）
+# ─────────────────────────────────────────────
+# trigram トークナイザは日本語の部分一致に対応。3文字未満の語はヒットしないので
+# search_mail() で LIKE 検索に切り替える
+MAIL_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mails (
+    id INTEGER PRIMARY KEY,
+    uidvalidity TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    message_id TEXT,
+    sender TEXT,
+    subject TEXT,
+    date TEXT,
+    body TEXT,
+    attachments TEXT,
+    indexed_at TEXT,
+    folder TEXT,
+    UNIQUE (uidvalidity, uid)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS mails_fts USING fts5(
+    sender, subject, body, attachments,
+    content='mails', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS mails_ai AFTER INSERT ON mails BEGIN
+    INSERT INTO mails_fts (rowid, sender, subject, body, attachments)
+    VALUES (new.id, new.sender, new.subject, new.body, new.attachments);
+END;
+CREATE TRIGGER IF NOT EXISTS mails_ad AFTER DELETE ON mails BEGIN
+    INSERT INTO mails_fts (mails_fts, rowid, sender, subject, body, attachments)
+    VALUES ('delete', old.id, old.sender, old.subject, old.body, old.attachments);
+END;
+"""
+
+
+def mail_record(uid, msg, sender_email, subject, body="", attachments=(), outcome=None):
+    """インデックス用レコード（本文未取得のメールは body 空で登録）
+
+    outcome は処理結果（ARCHIVE_FOLDERS のキー）。folder はアーカイブ後の所在で、
+    移動後は INBOX の UID が無効になるため検索結果では Message-ID と組で示す。
+    """
+    return {
+        "uid": uid.decode(),
+        "outcome": outcome,
+        "folder": "INBOX",
+        "message_id": (msg["Message-ID"] or "").strip(),
+        "sender": sender_email,
+        "subject": subject,
+        "date": msg["Date"] or "",
+        "body": body,
+        "attachments": "\n".join(attachments),
+    }
+
+
+def open_mail_index():
+    MAIL_INDEX_DB.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(MAIL_INDEX_DB)
+    conn.executescript(MAIL_INDEX_SCHEMA)
+    if "folder" not in {row[1] for row in conn.execute("PRAGMA table_info(mails)")}:
+        conn.execute("ALTER TABLE mails ADD COLUMN folder TEXT")
+    return conn
+
+
+def index_mails(records, uidvalidity):
+    """1回の実行で処理したメールを1トランザクションでまとめて登録"""
+    if not records:
+        return
+    now = datetime.now(JST).isoformat()
+    conn = open_mail_index()
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO mails (uidvalidity, uid, message_id, sender, subject,"
+                " date, body, attachments, indexed_at, folder)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(uidvalidity or "", int(r["uid"]), r["message_id"], r["sender"],
+                  r["subject"], r["date"], r["body"], r["attachments"], now, r["folder"])
+                 for r in records],
+            )
+    finally:
+        conn.close()
+
+
+def _like_pattern(term):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _like_snippet(text, term, width=16):
+    """LIKE 検索用の簡易スニペット（FTS5 の snippet() と同じ [語] 表記）"""
+    pos = text.lower().find(term.lower())
+    if pos < 0:
+        return text[:width * 2]
+    start = max(0, pos - width)
+    end = pos + len(term) + width
+    return (("…" if start else "") + text[start:pos] + f"[{text[pos:pos + len(term)]}]"
+            + text[pos + len(term):end] + ("…" if end < len(text) else ""))
+
+
+def search_mail(query, limit=10):
+    """処理済みメールを全文検索
+
+    クエリは空白区切りの語の AND 検索。FTS5 の演算子は解釈しない。
+    3文字以上の語は FTS5 で bm25 順に検索する。trigram で引けない2文字以下の語
+    （「投稿」「依頼」など）は LIKE の部分一致で絞り込み、語がすべて短い場合は
+    新しい順に返す（全件走査になる）。
+
+    Returns:
+        list[dict]: sender, subject, date, uid, message_id, folder, attachments, snippet
+            （uid は folder が INBOX の間だけ有効）
+    """
+    terms = query.split()
+    if not terms or not MAIL_INDEX_DB.exists():
+        return []
+    long_terms = ['"' + t.replace('"', '""') + '"' for t in terms if len(t) >= 3]
+    short_terms = [t for t in terms if len(t) < 3]
+
+    where, params = [], []
+    for t in short_terms:
+        where.append("(m.subject LIKE ? ESCAPE '\\' OR m.body LIKE ? ESCAPE '\\'"
+                     " OR m.sender LIKE ? ESCAPE '\\')")
+        params += [_like_pattern(t)] * 3
+
+    columns = ("m.uid, m.message_id, COALESCE(m.folder, 'INBOX') AS folder,"
+               " m.sender, m.subject, m.date, m.attachments, m.body")
+    if long_terms:
+        sql = (f"SELECT {columns}, snippet(mails_fts, -1, '[', ']', '…', 16) AS snippet"
+               " FROM mails_fts JOIN mails m ON m.id = mails_fts.rowid"
+               " WHERE mails_fts MATCH ?" + "".join(f" AND {w}" for w in where) +
+               " ORDER BY bm25(mails_fts) LIMIT ?")
+        params = [" ".join(long_terms)] + params + [limit]
+    else:
+        sql = (f"SELECT {columns}, NULL AS snippet FROM mails m"
+               " WHERE " + " AND ".join(where) + " ORDER BY m.id DESC LIMIT ?")
+        params.append(limit)
+
+    conn = open_mail_index()
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+    hits = []
+    for row in rows:
+        hit = dict(row)
+        body = hit.pop("body") or ""
+        if hit["snippet"] is None:
+            hit["snippet"] = _like_snippet(body or hit["subject"] or "", short_terms[0])
+        hits.append(hit)
+    return hits
+
+
+# ─────────────────────────────────────────────
+# アーカイブ（処理済みメールをINBOXから月別フォルダへ移動）
+# ─────────────────────────────────────────────
+def archive_folder(outcome, now=None):
+    """処理結果に対応する移動先フォルダ（移動しない場合は None）"""
+    template = ARCHIVE_FOLDERS.get(outcome)
+    if not template:
+        return None
+    return template.format(month=(now or datetime.now(JST)).strftime("%Y-%m"))
+
+
+def archive_mails(m, uids_by_folder):
+    """フォルダごとにUID範囲をまとめて1コマンドで移動
+
+    UID MOVE（RFC 6851）が使えなければ COPY + STORE \\Deleted + EXPUNGE で代替する。
+    UIDPLUS もないサーバーでは素の EXPUNGE になり、他の \\Deleted 付きメールも消える点に注意。
+
+    Returns:
+        set: 移動に成功したフォルダ
+    """
+    archived = set()
+    if not uids_by_folder:
+        return archived
+    caps = set()
+    status, cap_data = m.capability()
+    if status == "OK" and cap_data and cap_data[0]:
+        caps = set(cap_data[0].decode().upper().split())
+
+    for folder, uids in uids_by_folder.items():
+        uid_set = uid_ranges(uids)
+        try:
+            m.create(folder)  # 既存なら NO が返るだけ
+            if "MOVE" in caps:
+                method = "move"
+                status, _ = m.uid("MOVE", uid_set, folder)
+            else:
+                method = "copy"
+                status, _ = m.uid("COPY", uid_set, folder)
+                if status == "OK":
+                    status, _ = m.uid("STORE", uid_set, "+FLAGS.SILENT", "(\\Deleted)")
+                if status == "OK":
+                    if "UIDPLUS" in caps:
+                        status, _ = m.uid("EXPUNGE", uid_set)
+                    else:
+                        status, _ = m.expunge()
+            if status != "OK":
+                raise imaplib.IMAP4.error(f"{method} → {status}")
+            print(f"  → Archived {len(uids)} mail(s) to {folder} ({method})")
+            audit_log("mail_archived", folder=folder, uids=uid_set,
+                      count=len(uids), method=method)
+            archived.add(folder)
+        except Exception as e:
+            print(f"  ⚠️ アーカイブ失敗 ({folder}): {e}")
+            audit_log("archive_error", folder=folder, uids=uid_set, error=str(e))
+    return archived
+
+
+# ─────────────────────────────────────────────
+# メール1通の処理
+# ─────────────────────────────────────────────
+def handle_blocked_mail(uid, hdr, auth_detail):
+    """認証失敗メール: 本文を取得せずにアラートだけ送る"""
+    frm = decode_header_value(hdr["From"])
+    subj = decode_header_value(hdr["Subject"])
+    sender_email = extract_sender_email(frm)
+
+    print(f"  UID {uid.decode()}: From={sender_email} Subject={subj} (auth blocked)")
+    audit_log("mail_received",
+              uid=uid.decode(), sender=sender_email, subject=subj,
+              auto_process=True, auth_ok=False, auth_detail=auth_detail[:200])
+
+    print(f"  ⚠️ 認証失敗 — スキップ: {auth_detail}")
+    audit_log("mail_blocked", uid=uid.decode(),
+              sender=sender_email, reason=auth_detail[:200])
+    telegram_notify(
+        f"🚨 <b>メール認証失敗 — 自動処理をブロック</b>\n"
+        f"From: {sender_email}\nSubject: {subj}\n"
+        f"理由: {auth_detail[:200]}\n\n"
+        f"From詐称の可能性があります。手動で確認してください。"
+    )
+    return mail_record(uid, hdr, sender_email, subj, outcome="auth_blocked")
+
+
+def digest_entry(uid, hdr, bulk_reason):
+    """一括配信メール: 本文を取得せずダイジェスト用の1行にする"""
+    frm = decode_header_value(hdr["From"])
+    subj = decode_header_value(hdr["Subject"])
+    sender_email = extract_sender_email(frm)
+
+    print(f"  UID {uid.decode()}: From={sender_email} Subject={subj} (bulk: {bulk_reason})")
+    audit_log("mail_received",
+              uid=uid.decode(), sender=sender_email, subject=subj,
+              auto_process=False, bulk=True, bulk_reason=bulk_reason)
+    return mail_record(uid, hdr, sender_email, subj, outcome="digest")
+
+
+def duplicate_entry(uid, hdr, key):
+    """処理済みメールの再配信: 通知も起動もせず記録だけ残す"""
+    sender_email = extract_sender_email(decode_header_value(hdr["From"]))
+    subj = decode_header_value(hdr["Subject"])
+    print(f"  UID {uid.decode()}: From={sender_email} Subject={subj} (duplicate)")
+    audit_log("mail_duplicate", uid=uid.decode(), sender=sender_email,
+              subject=subj, key=key[:200])
+    return mail_record(uid, hdr, sender_email, subj, outcome="duplicate")
+
+
+def format_bulk_digest(items):
+    """ダイジェスト本文を組み立てる（送信者ごとにまとめる）"""
+    by_sender = {}
+    for item in items:
+        by_sender.setdefault(item["sender"], []).append(item["subject"])
+
+    lines = [f"📰 <b>一括配信メール {len(items)}通</b>"]
+    shown = 0
+    for sender, subjects in sorted(by_sender.items(), key=lambda kv: -len(kv[1])):
+        if shown >= BULK_DIGEST_MAX_ITEMS:
+            break
+        lines.append(f"\n{html.escape(sender, quote=False)} ({len(subjects)})")
+        for subj in subjects[:BULK_DIGEST_MAX_ITEMS - shown]:
+            lines.append(f"  ・{html.escape(subj[:60], quote=False)}")
+            shown += 1
+    if shown < len(items):
+        lines.append(f"\n…他{len(items) - shown}通")
+    return "\n".join(lines)
+
+
+def flush_bulk_digest(items, now=None):
+    """ダイジェストを送信（BULK_DIGEST_INTERVAL > 0 なら間隔が空くまで溜める）"""
+    if BULK_DIGEST_INTERVAL <= 0:
+        if items:
+            telegram_notify(format_bulk_digest(items))
+        return
+
+    now = now or time.time()
+    pending = {"since": now, "items": []}
+    if BULK_DIGEST_FILE.exists():
+        try:
+            pending = json.loads(BULK_DIGEST_FILE.read_text())
+        except (OSError, ValueError):
+            pass
+    if items and not pending["items"]:
+        pending["since"] = now
+    pending["items"].extend(items)
+
+    if pending["items"] and now - pending["since"] >= BULK_DIGEST_INTERVAL:
+        telegram_notify(format_bulk_digest(pending["items"]))
+        pending = {"since": now, "items": []}
+
+    BULK_DIGEST_FILE.parent.mkdir(parents=True, exist_ok=True)
+    BULK_DIGEST_FILE.write_text(json.dumps(pending, ensure_ascii=False))
+
+
+def cleanup_rule(outcome):
+    """エージェントへの後始末の指示（処理結果がアーカイブ対象なら削除不要）"""
+    if ARCHIVE_FOLDERS.get(outcome):
+        return "メールは処理後に自動でアーカイブされるため、IMAPでの削除は不要"
+    return "メール処理後はIMAPで該当メールを削除（Expunge）すること"
+
+
+def process_mail(uid, lane, msg, auth_detail, body, attachments):
+    """本文・添付の取り出しが済んだメールを自動処理 or 通知
+
+    Returns:
+        dict: 検索インデックス用レコード
+    """
+    frm = decode_header_value(msg["From"])
+    subj = decode_header_value(msg["Subject"])
+    sender_email = extract_sender_email(frm)
+
+    print(f"  UID {uid.decode()}: From={sender_email} Subject={subj} Attachments={len(attachments)}")
+
+    if lane == LANE_AUTO_PROCESS:
+        audit_log("mail_received",
+                  uid=uid.decode(), sender=sender_email, subject=subj,
+                  auto_process=True, auth_ok=True, auth_detail=auth_detail[:200],
+                  attachments=len(attachments))
+
+        if auth_detail != "認証OK":
+            print(f"  ℹ️ 認証警告: {auth_detail}")
+
+        # ── 自律処理 ──
+        sender_name = "VIP送信者" if "kawashima" in sender_email else "オーナー"
+
+        att_info = ""
+        if attachments:
+            att_list = "\n".join([f"  - {f}" for f in attachments])
+            att_info = f"\n\n添付ファイル（~/workspace/assets/tmp/ に保存済み）:\n{att_list}"
+
+        def build_task(outcome):
+            return f"""📧 {sender_name}からメールが届きました。内容を読んで自律的に対応してください。
+
+From: {frm}
+Subject: {subj}
+Date: {msg['Date']}
+
+【メール本文】
+{body}
+{att_info}
+
+【対応ルール】
+- VIP送信者からの投稿依頼 → イラスト生成・キャプション作成・確認メール送信・OK後に投稿
+- オーナーからの指示 → 内容に応じて判断・実行
+- 対応完了後、Telegramでオーナーに完了報告すること
+- {cleanup_rule(outcome)}
+- 簡潔なメッセージは短く返答してOK"""
+
+        started = time.monotonic()
+        success = wake_akiko(build_task("auto_process"))
+        audit_log("mail_processed", uid=uid.decode(),
+                  sender=sender_email, action="system_event",
+                  success=success, latency_ms=int((time.monotonic() - started) * 1000))
+        if not success:
+            # 一時的な障害は再送キューで吸収する（上限超過時のみ手動対応を依頼）
+            # このメールは auto_process_failed として扱われるので、後始末の指示もそれに合わせる
+            enqueue_outbound("system_event", build_task("auto_process_failed"),
+                             uid=uid.decode(), sender=sender_email, subject=subj)
+        outcome = "auto_process" if success else "auto_process_failed"
+    else:
+        # その他 → Telegram通知のみ
+        audit_log("mail_received",
+                  uid=uid.decode(), sender=sender_email, subject=subj,
+                  auto_process=False)
+        preview = body[:200]
+        telegram_notify(
+            f"📧 <b>新着メール</b>\n"
+            f"From: {frm}\nSubject: {subj}\n\n{preview}"
+        )
+        outcome = "notify"
+
+    return mail_record(uid, msg, sender_email, subj, body, attachments, outcome=outcome)
+
+# ─────────────────────────────────────────────
+# パイプライン（取得 → 解析 → 添付保存 → 通知/起動 を並行実行）
+# ─────────────────────────────────────────────
+# ステージ間キューの上限（取得だけが先走ってメモリを食わないように）
+PIPELINE_QUEUE_SIZE = 8
+
+_PIPELINE_END = object()
+
+
+def _run_stage(stage, item):
+    """前段でエラーになったメールは素通しする"""
+    if "error" in item:
+        return
+    try:
+        stage(item)
+    except Exception as e:
+        item["error"] = e
+
+
+def run_pipeline(items, stages, finish):
+    """items を stages に順に流す（ステージごとに1スレッド、有界キューで接続）
+
+    各ステージは単一スレッドのFIFOなので、メールの処理順は items の順のまま。
+    先頭ステージは呼び出し元スレッドで実行する（IMAP接続を1スレッドに限定）。
+    finish はエラーの有無にかかわらず最終ステージのスレッドで全件に呼ばれる。
+    """
+    queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in stages[1:]]
+
+    def worker(stage, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _PIPELINE_END:
+                if outbox is not None:
+                    outbox.put(item)
+                return
+            _run_stage(stage, item)
+            if outbox is not None:
+                outbox.put(item)
+                continue
+            try:
+                finish(item)
+            except Exception as e:
+                print(f"  ⚠️ UID {item['uid'].decode()} 完了処理エラー: {e}")
+
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(stage, queues[i], queues[i + 1] if i + 1 < len(queues) else None),
+            daemon=True)
+        for i, stage in enumerate(stages[1:])
+    ]
+    for t in threads:
+        t.start()
+    try:
+        for item in items:
+            _run_stage(stages[0], item)
+            queues[0].put(item)
+    finally:
+        queues[0].put(_PIPELINE_END)
+        for t in threads:
+            t.join()
+
+
+def stage_parse(item):
+    if item.get("msg") is not None:
+        item["body"] = extract_body(item["msg"])
+
+
+def stage_persist(item):
+    if item.get("msg") is not None:
+        item["attachments"] = extract_attachments(item["msg"])
+
+
+def stage_dispatch(item):
+    uid, lane, hdr, auth_detail = item["uid"], item["lane"], item["hdr"], item["auth_detail"]
+    if lane == LANE_AUTH_BLOCKED:
+        item["record"] = handle_blocked_mail(uid, hdr, auth_detail)
+    elif lane == LANE_DIGEST:
+        item["record"] = digest_entry(uid, hdr, auth_detail)
+    elif item.get("msg") is not None:
+        item["record"] = process_mail(uid, lane, item["msg"], auth_detail,
+                                      item["body"], item["attachments"])
+
+
 # ─────────────────────────────────────────────
 # メイン処理
 # ─────────────────────────────────────────────
@@ -386,6 +1476,7 @@ def check_mail():
             if saved_uv and saved_uv != uidvalidity:
                 print(f"  ⚠️ UIDVALIDITY changed: {saved_uv} → {uidvalidity} — resetting last_seen_uid")
                 save_last_seen_uid("0")
+                save_completed_uids(())
                 audit_log("uidvalidity_reset", old=saved_uv, new=uidvalidity)
                 telegram_notify(
                     "⚠️ <b>IMAP UIDVALIDITY変更検知</b>\n"
@@ -396,118 +1487,144 @@ def check_mail():
         last_uid = get_last_seen_uid()
 
         status, data = m.uid("search", None, f"UID {int(last_uid)+1}:*")
-        if status != "OK" or not data[0]:
-            m.logout()
-            return
-
-        uids = data[0].split()
+        uids = data[0].split() if status == "OK" and data[0] else []
         uids = [u for u in uids if int(u) > int(last_uid)]
 
         if not uids:
+            # 新着がなくても、間隔の過ぎた溜め置きダイジェストはここで送る
+            flush_bulk_digest([])
             m.logout()
             return
 
         now_jst = datetime.now(JST)
         print(f"[{now_jst.strftime('%Y-%m-%d %H:%M JST')}] {len(uids)} new mail(s)")
 
-        max_uid = 0
+        # ── フェーズ1: ヘッダだけで全UIDをレーンに振り分け ──
+        # 前回の実行が途中で落ちる前に処理し終えていたUIDは取得もしない
+        completed = get_completed_uids()
+        headers = fetch_headers(m, [u for u in uids if int(u) not in completed])
+        sender_stats = load_sender_stats()
+        lanes = {LANE_AUTH_BLOCKED: [], LANE_AUTO_PROCESS: [], LANE_NOTIFY: [], LANE_DIGEST: []}
+        prefetched = {}
+        watermark = UidWatermark(uids)
+        dedup = DedupFilter.load(DEDUP_FILE)
+        duplicate_records = []
         for uid in uids:
-            try:
-                status, msg_data = m.uid("fetch", uid, "(RFC822)")
-                if status != "OK":
+            if int(uid) in completed:
+                watermark.complete(uid)
+                continue
+            hdr = headers.get(uid)
+            if hdr is None:
+                # 一括取得で返らなかったUIDは全体を取得して判定
+                hdr = fetch_message(m, uid)
+                if hdr is None:
+                    watermark.complete(uid)
                     continue
-                msg = email.message_from_bytes(msg_data[0][1])
-
-                frm = decode_header_value(msg["From"])
-                subj = decode_header_value(msg["Subject"])
-                sender_email = extract_sender_email(frm)
-                body = extract_body(msg)
-                attachments = extract_attachments(msg)
-
-                print(f"  UID {uid.decode()}: From={sender_email} Subject={subj} Attachments={len(attachments)}")
-
-                if sender_email in AUTO_PROCESS_SENDERS:
-                    # ── メール認証検証 ──
-                    auth_ok, auth_detail = verify_email_auth(msg, sender_email)
-
-                    audit_log("mail_received",
-                              uid=uid.decode(), sender=sender_email, subject=subj,
-                              auto_process=True, auth_ok=auth_ok, auth_detail=auth_detail[:200],
-                              attachments=len(attachments))
-
-                    if not auth_ok:
-                        print(f"  ⚠️ 認証失敗 — スキップ: {auth_detail}")
-                        audit_log("mail_blocked", uid=uid.decode(),
-                                  sender=sender_email, reason=auth_detail[:200])
-                        telegram_notify(
-                            f"🚨 <b>メール認証失敗 — 自動処理をブロック</b>\n"
-                            f"From: {sender_email}\nSubject: {subj}\n"
-                            f"理由: {auth_detail[:200]}\n\n"
-                            f"From詐称の可能性があります。手動で確認してください。"
-                        )
-                        if int(uid) > max_uid:
-                            max_uid = int(uid)
-                        continue
-
-                    if auth_detail != "認証OK":
-                        print(f"  ℹ️ 認証警告: {auth_detail}")
-
-                    # ── 自律処理 ──
-                    sender_name = "VIP送信者" if "kawashima" in sender_email else "オーナー"
-
-                    att_info = ""
-                    if attachments:
-                        att_list = "\n".join([f"  - {f}" for f in attachments])
-                        att_info = f"\n\n添付ファイル（~/workspace/assets/tmp/ に保存済み）:\n{att_list}"
-
-                    task = f"""📧 {sender_name}からメールが届きました。内容を読んで自律的に対応してください。
-
-From: {frm}
-Subject: {subj}
-Date: {msg['Date']}
-
-【メール本文】
-{body}
-{att_info}
-
-【対応ルール】
-- VIP送信者からの投稿依頼 → イラスト生成・キャプション作成・確認メール送信・OK後に投稿
-- オーナーからの指示 → 内容に応じて判断・実行
-- 対応完了後、Telegramでオーナーに完了報告すること
-- メール処理後はIMAPで該当メールを削除（Expunge）すること
-- 簡潔なメッセージは短く返答してOK"""
+                prefetched[uid] = hdr
 
-                    success = wake_akiko(task)
-                    audit_log("mail_processed", uid=uid.decode(),
-                              sender=sender_email, action="system_event",
-                              success=success)
-                    if not success:
-                        telegram_notify(
-                            f"📧 <b>⚡ {sender_name}からメール（自動処理失敗）</b>\n"
-                            f"Subject: {subj}\n\n{body[:300]}\n\n"
-                            f"⚠️ 手動で対応してください。"
-                        )
-                else:
-                    # その他 → Telegram通知のみ
-                    audit_log("mail_received",
-                              uid=uid.decode(), sender=sender_email, subject=subj,
-                              auto_process=False)
-                    preview = body[:200]
-                    telegram_notify(
-                        f"📧 <b>新着メール</b>\n"
-                        f"From: {frm}\nSubject: {subj}\n\n{preview}"
-                    )
+            # キーを作れないメールは重複なしとして通常処理に回す
+            try:
+                key = dedup_key(hdr)
+            except Exception as e:
+                print(f"  ⚠️ UID {uid.decode()} 重複判定エラー: {e}")
+                key = None
 
+            try:
+                lane, auth_detail = classify_mail(hdr, sender_stats)
+                # 転送・ML重複・UIDVALIDITYリセット後の再配信は本文取得前に除外
+                # 認証NGのコピーは警告を出すため重複扱いにしない
+                if key is not None and lane != LANE_AUTH_BLOCKED and key in dedup:
+                    duplicate_records.append(duplicate_entry(uid, hdr, key))
+                    prefetched.pop(uid, None)
+                    watermark.complete(uid)
+                    continue
+                record_sender(sender_stats,
+                              extract_sender_email(decode_header_value(hdr["From"])),
+                              auth_detail if lane == LANE_DIGEST else None)
             except Exception as e:
+                # 壊れたヘッダ1通で実行全体を止めない（ベースラインと同じく mail_error で飛ばす）
+                print(f"  ⚠️ UID {uid.decode()} 分類エラー: {e}")
+                audit_log("mail_error", uid=uid.decode(), error=str(e))
+                telegram_error(f"UID {uid.decode()} 分類エラー: {e}")
+                prefetched.pop(uid, None)
+                watermark.complete(uid)
+                continue
+            lanes[lane].append((uid, hdr, auth_detail, key))
+        save_sender_stats(sender_stats)
+
+        print(f"  lanes: blocked={len(lanes[LANE_AUTH_BLOCKED])} "
+              f"auto={len(lanes[LANE_AUTO_PROCESS])} notify={len(lanes[LANE_NOTIFY])} "
+              f"digest={len(lanes[LANE_DIGEST])} duplicate={len(duplicate_records)}")
+
+        # ── フェーズ2: 優先度の高いレーンから、取得/解析/添付保存/通知を重ねて処理 ──
+        digest_items = []
+        index_records = []
+
+        def stage_fetch(item):
+            if item["lane"] in (LANE_AUTO_PROCESS, LANE_NOTIFY):
+                item["msg"] = prefetched.pop(item["uid"], None) or fetch_message(m, item["uid"])
+
+        def stage_dispatch_once(item):
+            # 同じ実行内のコピーはここで判定する（finish と同じスレッドなので
+            # 先に処理し終えたコピーの結果が dedup に入っている）
+            key = item["dedup_key"]
+            if key is not None and item["lane"] != LANE_AUTH_BLOCKED and key in dedup:
+                item["record"] = duplicate_entry(item["uid"], item["hdr"], key)
+                return
+            stage_dispatch(item)
+
+        def finish(item):
+            uid = item["uid"]
+            record = item.get("record")
+            if "error" in item:
+                e = item["error"]
                 print(f"  ⚠️ UID {uid.decode()} 処理エラー: {e}")
                 audit_log("mail_error", uid=uid.decode(), error=str(e))
                 telegram_error(f"UID {uid.decode()} 処理エラー: {e}")
+            elif record and record["outcome"] == "duplicate":
+                duplicate_records.append(record)
+            elif record:
+                index_records.append(record)
+                if item["lane"] == LANE_DIGEST:
+                    digest_items.append(record)
+                if item["dedup_key"] is not None and record["outcome"] in DEDUP_OUTCOMES:
+                    dedup.add(item["dedup_key"])
+
+            new_mark = watermark.complete(uid)
+            if new_mark:
+                save_last_seen_uid(new_mark)
+            save_completed_uids(watermark.done)
+
+        items = [{"uid": uid, "lane": lane, "hdr": hdr, "auth_detail": auth_detail, "dedup_key": key}
+                 for lane in sorted(lanes) for uid, hdr, auth_detail, key in lanes[lane]]
+        run_pipeline(items, [stage_fetch, stage_parse, stage_persist, stage_dispatch_once], finish)
+
+        flush_bulk_digest(digest_items)
+
+        # 途中で落ちた場合、処理済みのUIDは COMPLETED_UIDS_FILE で飛ばされる
+        dedup.save(DEDUP_FILE)
+
+        archive_plan = {}
+        for record in index_records + duplicate_records:
+            folder = archive_folder(record["outcome"], now_jst)
+            if folder:
+                archive_plan.setdefault(folder, []).append(record["uid"])
+        archived = archive_mails(m, archive_plan)
+
+        # 移動先を記録してからインデックスに登録（移動後は INBOX の UID では探せない）
+        for record in index_records:
+            folder = archive_folder(record["outcome"], now_jst)
+            if folder in archived:
+                record["folder"] = folder
+        try:
+            index_mails(index_records, uidvalidity)
+        except sqlite3.Error as e:
+            print(f"  ⚠️ 検索インデックス更新失敗: {e}")
+            audit_log("index_error", error=str(e))
 
-            if int(uid) > max_uid:
-                max_uid = int(uid)
-
-        if max_uid > 0:
-            save_last_seen_uid(max_uid)
+        if watermark.mark > 0:
+            save_last_seen_uid(watermark.mark)
+        save_completed_uids(watermark.done)
 
     except Exception as e:
         error_msg = f"メールチェック中にエラー: {e}"
@@ -522,11 +1639,51 @@ Date: {msg['Date']}
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="agent@example.com の新着メールをチェック")
+    subparsers = parser.add_subparsers(dest="command")
+    search_parser = subparsers.add_parser("search", help="処理済みメールを全文検索")
+    search_parser.add_argument("query")
+    search_parser.add_argument("-n", "--limit", type=int, default=10)
+    stats_parser = subparsers.add_parser("stats", help="監査ログの集計レポート")
+    stats_parser.add_argument("--month", help="送信者別集計の対象月（YYYY-MM、既定: 今月）")
+    stats_parser.add_argument("--top", type=int, default=10)
+    drain_parser = subparsers.add_parser("drain", help="再送キューを処理")
+    drain_parser.add_argument("--loop", type=int, metavar="SECONDS",
+                              help="指定秒ごとに再送し続ける（デーモンモード）")
+    args = parser.parse_args()
+
+    if args.command == "drain":
+        while True:
+            drain_outbox()
+            if not args.loop:
+                break
+            time.sleep(args.loop)
+        sys.exit(0)
+
+    if args.command == "stats":
+        print(format_audit_report(update_audit_stats(), args.month, args.top))
+        sys.exit(0)
+
+    if args.command == "search":
+        for hit in search_mail(args.query, args.limit):
+            location = f"INBOX UID {hit['uid']}" if hit["folder"] == "INBOX" else hit["folder"]
+            print(f"{location}  {hit['date']}  {hit['sender']}  {hit['subject']}")
+            if hit["message_id"]:
+                print(f"    Message-ID: {hit['message_id']}")
+            print(f"    {hit['snippet']}")
+            if hit["attachments"]:
+                print(f"    添付: {hit['attachments'].replace(chr(10), ', ')}")
+        sys.exit(0)
+
     lock = FileLock(LOCK_FILE)
     if not lock.acquire():
         print("Another instance is running — skipping")
         sys.exit(0)
     try:
+        # 再送は別スレッドで並行実行し、新着メールの処理を待たせない
+        drainer = threading.Thread(target=drain_outbox, daemon=True)
+        drainer.start()
         check_mail()
+        drainer.join()
     finally:
         lock.release()
@@ -8,7 +8,9 @@
 受信サーバー: mx.hetemail.jp（ヘテムルレンタルサーバー）
 """
 
-import sys, os, email
+import sys, os, email, time, json, re, tempfile
+from contextlib import contextmanager
+from datetime import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
@@ -41,6 +43,113 @@ def make_msg(from_addr, subject="test", body="test body", auth_results=None):
     return msg
 
 
+# 状態ファイル・ログの保存先（テスト中は一時ディレクトリに差し替える）
+STATE_PATHS = [
+    "STATE_FILE", "COMPLETED_UIDS_FILE", "UIDVALIDITY_FILE", "AUDIT_LOG", "AUDIT_STATS_FILE",
+    "SENDER_STATS_FILE", "BULK_DIGEST_FILE", "MAIL_INDEX_DB", "OUTBOX_DIR",
+    "OUTBOX_LOCK_FILE", "DEDUP_FILE", "MAIL_CONFIG", "TMP_DIR",
+]
+
+
+@contextmanager
+def isolated_state():
+    """状態ファイル・監査ログ・外部送信を一時的に差し替える
+
+    Yields:
+        (Path, list): (一時ディレクトリ, 送信内容 [(種別, 本文)])
+    """
+    tmp = Path(tempfile.mkdtemp())
+    saved = {name: getattr(check_mail, name) for name in STATE_PATHS}
+    saved_funcs = check_mail.send_telegram, check_mail.wake_akiko
+    sent = []
+    for name in STATE_PATHS:
+        setattr(check_mail, name, tmp / name.lower())
+    check_mail.send_telegram = lambda text: sent.append(("telegram", text)) or check_mail.SEND_OK
+    check_mail.wake_akiko = lambda text: sent.append(("system_event", text)) or True
+    try:
+        yield tmp, sent
+    finally:
+        for name, value in saved.items():
+            setattr(check_mail, name, value)
+        check_mail.send_telegram, check_mail.wake_akiko = saved_funcs
+
+
+class FakeMailbox:
+    """check_mail() を通しで動かすための最小限の IMAP サーバー"""
+    def __init__(self, messages, capabilities="IMAP4rev1 MOVE UIDPLUS"):
+        self.messages = messages  # {uid(int): bytes}
+        self.capabilities = capabilities
+        self.calls = []
+
+    def __call__(self, host):
+        return self
+
+    def login(self, user, password):
+        return "OK", [b""]
+
+    def select(self, mailbox):
+        return "OK", [str(len(self.messages)).encode()]
+
+    def status(self, mailbox, query):
+        return "OK", [b"INBOX (UIDVALIDITY 1)"]
+
+    def capability(self):
+        return "OK", [self.capabilities.encode()]
+
+    def create(self, folder):
+        return "NO", [b"already exists"]
+
+    def expunge(self):
+        return "OK", [None]
+
+    def logout(self):
+        return "BYE", [b""]
+
+    def _uid_set(self, uid_set):
+        if isinstance(uid_set, bytes):
+            uid_set = uid_set.decode()
+        uids = []
+        for part in uid_set.split(","):
+            lo, _, hi = part.partition(":")
+            uids.extend(range(int(lo), int(hi or lo) + 1))
+        return [u for u in uids if u in self.messages]
+
+    def uid(self, command, *args):
+        self.calls.append((command,) + args)
+        if command == "search":
+            low = int(re.search(r"UID (\d+):", args[1]).group(1))
+            return "OK", [" ".join(str(u) for u in sorted(self.messages) if u >= low).encode()]
+        if command == "fetch":
+            data = []
+            for n, u in enumerate(self._uid_set(args[0]), 1):
+                raw = self.messages[u]
+                if "HEADER" in args[1]:
+                    raw = raw.split(b"\n\n")[0] + b"\n\n"
+                data += [(b"%d (UID %d BODY[] {%d}" % (n, u, len(raw)), raw), b")"]
+            return "OK", data
+        return "OK", [None]
+
+
+def run_check_mail(messages, **kwargs):
+    """FakeMailbox に対して check_mail() を1回実行"""
+    mailbox = FakeMailbox(messages, **kwargs)
+    check_mail.MAIL_CONFIG.write_text(json.dumps(
+        {"imap_server": "imap.example.com", "email": "agent@example.com", "password": "x"}))
+    saved = check_mail.imaplib.IMAP4_SSL
+    check_mail.imaplib.IMAP4_SSL = mailbox
+    try:
+        check_mail.check_mail()
+    finally:
+        check_mail.imaplib.IMAP4_SSL = saved
+    return mailbox
+
+
+def read_audit_events():
+    if not check_mail.AUDIT_LOG.exists():
+        return []
+    return [json.loads(line) for line in check_mail.AUDIT_LOG.read_text().splitlines()]
+
+
 # ─────────────────────────────────────────────
 # 経路1: Gmail (goodsun0317@gmail.com)
 # ─────────────────────────────────────────────
@@ -265,6 +374,663 @@ def test_body_normal():
     print("✅ test_body_normal")
 
 
+# ─────────────────────────────────────────────
+# 優先度レーン
+# ─────────────────────────────────────────────
+def test_uid_ranges():
+    """UIDリスト → IMAPシーケンスセットに圧縮"""
+    assert check_mail.uid_ranges([b"1", b"2", b"3", b"7", b"9", b"10"]) == "1:3,7,9:10"
+    assert check_mail.uid_ranges([b"5"]) == "5"
+    assert check_mail.uid_ranges([]) == ""
+    print("✅ test_uid_ranges")
+
+
+def test_classify_lanes():
+    """VIP(認証OK) → 自動処理, VIP(認証NG) → ブロック, その他 → 通知"""
+    check_mail.AUTO_PROCESS_SENDERS = ["goodsun0317@gmail.com"]
+    try:
+        ok_msg = make_msg(
+            "goodsun <goodsun0317@gmail.com>",
+            auth_results="mx.hetemail.jp;\n\tdkim=pass;\n\tspf=pass;\n\tdmarc=pass",
+        )
+        ng_msg = make_msg("goodsun <goodsun0317@gmail.com>")
+        other = make_msg("news <news@example.com>")
+        assert check_mail.classify_mail(ok_msg)[0] == check_mail.LANE_AUTO_PROCESS
+        assert check_mail.classify_mail(ng_msg)[0] == check_mail.LANE_AUTH_BLOCKED
+        assert check_mail.classify_mail(other)[0] == check_mail.LANE_NOTIFY
+    finally:
+        check_mail.AUTO_PROCESS_SENDERS = []
+    print("✅ test_classify_lanes")
+
+
+def test_fetch_headers_batch():
+    """ヘッダ一括取得: 1コマンドでUIDごとのヘッダを返す"""
+    class FakeIMAP:
+        def __init__(self):
+            self.calls = []
+
+        def uid(self, command, uid_set, query):
+            self.calls.append((command, uid_set, query))
+            return "OK", [
+                (b"1 (UID 10 BODY[HEADER] {30}", b"From: a@example.com\r\nSubject: A\r\n\r\n"),
+                b")",
+                (b"2 (UID 11 BODY[HEADER] {30}", b"From: b@example.com\r\nSubject: B\r\n\r\n"),
+                b")",
+            ]
+
+    m = FakeIMAP()
+    headers = check_mail.fetch_headers(m, [b"10", b"11"])
+    assert m.calls == [("fetch", "10:11", "(BODY.PEEK[HEADER])")]
+    assert headers[b"10"]["Subject"] == "A"
+    assert headers[b"11"]["From"] == "b@example.com"
+    print("✅ test_fetch_headers_batch")
+
+
+def test_watermark_out_of_order():
+    """順不同で完了しても、未完了UIDを飛び越えて last_seen_uid を進めない"""
+    wm = check_mail.UidWatermark([b"10", b"11", b"12", b"13"])
+    assert wm.complete(b"12") is None  # 10, 11 が未完了
+    assert wm.complete(b"10") == 10
+    assert wm.complete(b"13") is None  # 11 が未完了
+    assert wm.complete(b"11") == 13
+    print("✅ test_watermark_out_of_order")
+
+
+def test_completed_uids_survive_crash():
+    """先に処理し終えたVIPメールは、途中で落ちた後の再実行で二重に起動しない"""
+    vip = make_msg(
+        "goodsun <goodsun0317@gmail.com>", subject="投稿お願い",
+        auth_results="mx.hetemail.jp;\n\tdkim=pass;\n\tspf=pass;\n\tdmarc=pass",
+    )
+    messages = {1: make_msg("a <a@example.com>").as_bytes(),
+                2: make_msg("b <b@example.com>").as_bytes(),
+                3: vip.as_bytes()}
+    check_mail.AUTO_PROCESS_SENDERS = ["goodsun0317@gmail.com"]
+    saved_fetch = check_mail.fetch_message
+    try:
+        with isolated_state() as (tmp, sent):
+            # UID 3 の起動後、UID 1 の取得中にプロセスが落ちたことにする
+            def crashing_fetch(m, uid):
+                if uid == b"1":
+                    raise SystemExit(1)
+                return saved_fetch(m, uid)
+
+            check_mail.fetch_message = crashing_fetch
+            try:
+                run_check_mail(messages)
+            except SystemExit:
+                pass
+            assert check_mail.get_last_seen_uid() == "0"
+            assert check_mail.get_completed_uids() == {3}
+            assert not check_mail.DEDUP_FILE.exists()  # 重複判定の保存までは届いていない
+
+            check_mail.fetch_message = saved_fetch
+            run_check_mail(messages)
+            assert len([kind for kind, _ in sent if kind == "system_event"]) == 1
+            assert len([kind for kind, _ in sent if kind == "telegram"]) == 2
+            assert check_mail.get_last_seen_uid() == "3"
+            assert check_mail.get_completed_uids() == set()
+    finally:
+        check_mail.fetch_message = saved_fetch
+        check_mail.AUTO_PROCESS_SENDERS = []
+    print("✅ test_completed_uids_survive_crash")
+
+
+# ─────────────────────────────────────────────
+# 一括配信メール / ダイジェスト
+# ─────────────────────────────────────────────
+def test_detect_bulk_headers():
+    """List-Id / Precedence / Auto-Submitted → 一括配信"""
+    msg = make_msg("news <news@example.com>")
+    assert check_mail.detect_bulk_mail(msg) is None
+    msg["List-Unsubscribe"] = "<mailto:unsub@example.com>"
+    assert check_mail.detect_bulk_mail(msg) == "list"
+
+    msg = make_msg("shop <shop@example.com>")
+    msg["Precedence"] = "Bulk"
+    assert check_mail.detect_bulk_mail(msg) == "precedence"
+
+    msg = make_msg("system <system@example.com>")
+    msg["Auto-Submitted"] = "no"
+    assert check_mail.detect_bulk_mail(msg) is None
+    msg.replace_header("Auto-Submitted", "auto-generated")
+    assert check_mail.detect_bulk_mail(msg) == "auto-submitted"
+    msg.replace_header("Auto-Submitted", "auto-replied")
+    assert check_mail.detect_bulk_mail(msg) == "auto-replied"
+    print("✅ test_detect_bulk_headers")
+
+
+def test_detect_bulk_reputation():
+    """受信の大半が一括配信の送信者 → ヘッダなしでも一括配信"""
+    news = make_msg("news <news@example.com>")
+    stats = {}
+    check_mail.record_sender(stats, "news@example.com", "list")
+    check_mail.record_sender(stats, "news@example.com", "list")
+    assert check_mail.detect_bulk_mail(news, stats) is None  # 件数が少ないうちは判定しない
+    check_mail.record_sender(stats, "news@example.com", "list")
+    assert check_mail.detect_bulk_mail(news, stats) == "reputation"
+    # 評判で判定したメールは数えない
+    check_mail.record_sender(stats, "news@example.com", "reputation")
+    assert stats["news@example.com"] == {"total": 3, "bulk": 3}
+
+    # 一括配信が混じっても、普段やり取りしている相手は個人宛のまま
+    friend = make_msg("friend <friend@example.com>")
+    for _ in range(10):
+        check_mail.record_sender(stats, "friend@example.com", None)
+    for _ in range(3):
+        check_mail.record_sender(stats, "friend@example.com", "list")
+    assert check_mail.detect_bulk_mail(friend, stats) is None
+
+    # 不在通知だけが続いても一括配信扱いにしない
+    for _ in range(5):
+        check_mail.record_sender(stats, "boss@example.com", "auto-replied")
+    assert check_mail.detect_bulk_mail(make_msg("boss <boss@example.com>"), stats) is None
+    print("✅ test_detect_bulk_reputation")
+
+
+def test_vip_never_digested():
+    """VIP送信者は一括配信ヘッダがあってもダイジェストに入れない"""
+    check_mail.AUTO_PROCESS_SENDERS = ["goodsun0317@gmail.com"]
+    try:
+        msg = make_msg("goodsun <goodsun0317@gmail.com>")
+        msg["List-Id"] = "<list.example.com>"
+        assert check_mail.classify_mail(msg)[0] != check_mail.LANE_DIGEST
+    finally:
+        check_mail.AUTO_PROCESS_SENDERS = []
+    print("✅ test_vip_never_digested")
+
+
+def test_bulk_digest_format():
+    """ダイジェスト: 送信者ごとにまとめ、上限超過分は件数のみ"""
+    items = [{"uid": str(i), "sender": "news@example.com", "subject": f"news {i}"}
+             for i in range(check_mail.BULK_DIGEST_MAX_ITEMS + 5)]
+    text = check_mail.format_bulk_digest(items)
+    assert f"{len(items)}通" in text
+    assert "news@example.com" in text
+    assert "他5通" in text
+    print("✅ test_bulk_digest_format")
+
+
+def test_bulk_digest_escapes_html():
+    """件名・送信者の < > & はエスケープ（Telegram HTML モードで 400 にしない）"""
+    items = [{"uid": "1", "sender": "news<x>@example.com", "subject": "<重要> A&B"}]
+    text = check_mail.format_bulk_digest(items)
+    assert "<重要>" not in text and "&lt;重要&gt; A&amp;B" in text
+    assert "news&lt;x&gt;@example.com" in text
+    assert "<b>" in text  # 見出しの書式タグはそのまま
+    print("✅ test_bulk_digest_escapes_html")
+
+
+def test_bulk_digest_interval_flushes_without_new_mail():
+    """溜め置き中のダイジェストは、新着のない実行でも間隔が過ぎれば送る"""
+    saved = check_mail.BULK_DIGEST_INTERVAL
+    check_mail.BULK_DIGEST_INTERVAL = 3600
+    try:
+        with isolated_state() as (tmp, sent):
+            items = [{"uid": "7", "sender": "news@example.com", "subject": "週刊ニュース"}]
+            check_mail.BULK_DIGEST_FILE.write_text(json.dumps(
+                {"since": time.time() - 7200, "items": items}))
+            run_check_mail({})
+            assert len(sent) == 1 and "週刊ニュース" in sent[0][1]
+            pending = json.loads(check_mail.BULK_DIGEST_FILE.read_text())
+            assert pending["items"] == []
+    finally:
+        check_mail.BULK_DIGEST_INTERVAL = saved
+    print("✅ test_bulk_digest_interval_flushes_without_new_mail")
+
+
+# ─────────────────────────────────────────────
+# 全文検索インデックス
+# ─────────────────────────────────────────────
+def test_mail_index_search():
+    """処理済みメールを登録 → 日本語の部分一致で検索できる"""
+    with isolated_state():
+        vip = make_msg("川嶋比野 <kawashima@toita.ac.jp>", subject="投稿のお願い")
+        news = make_msg("news <news@example.com>", subject="今週のお知らせ")
+        records = [
+            check_mail.mail_record(b"10", vip, "kawashima@toita.ac.jp", "投稿のお願い",
+                                   "春のイラストを投稿してください", ["/tmp/photo.jpg"]),
+            check_mail.mail_record(b"11", news, "news@example.com", "今週のお知らせ"),
+        ]
+        check_mail.index_mails(records, "1")
+        check_mail.index_mails(records, "1")  # 再登録しても重複しない
+
+        hits = check_mail.search_mail("イラスト")
+        assert [h["uid"] for h in hits] == [10]
+        assert hits[0]["attachments"] == "/tmp/photo.jpg"
+        assert len(check_mail.search_mail("お知らせ")) == 1
+        assert check_mail.search_mail('"; DROP') == []
+    print("✅ test_mail_index_search")
+
+
+def test_mail_index_search_short_terms():
+    """2文字の語（trigram で引けない）も LIKE で検索できる"""
+    with isolated_state():
+        vip = make_msg("川嶋比野 <kawashima@toita.ac.jp>", subject="投稿依頼")
+        news = make_msg("news <news@example.com>", subject="写真展のお知らせ")
+        check_mail.index_mails([
+            check_mail.mail_record(b"10", vip, "kawashima@toita.ac.jp", "投稿依頼",
+                                   "春のイラストを投稿してください"),
+            check_mail.mail_record(b"11", news, "news@example.com", "写真展のお知らせ",
+                                   "100%_還元"),
+        ], "1")
+
+        hits = check_mail.search_mail("投稿")
+        assert [h["uid"] for h in hits] == [10]
+        assert "[投稿]" in hits[0]["snippet"]
+        assert [h["uid"] for h in check_mail.search_mail("依頼")] == [10]
+        assert [h["uid"] for h in check_mail.search_mail("写真")] == [11]
+        # 長い語と短い語の組み合わせ
+        assert [h["uid"] for h in check_mail.search_mail("イラスト 投稿")] == [10]
+        assert check_mail.search_mail("イラスト 写真") == []
+        # LIKE のワイルドカードは文字として扱う
+        assert [h["uid"] for h in check_mail.search_mail("%_")] == [11]
+        assert [h["uid"] for h in check_mail.search_mail("_")] == [11]
+    print("✅ test_mail_index_search_short_terms")
+
+
+def test_mail_index_records_archive_folder():
+    """アーカイブされたメールは移動先フォルダと Message-ID で探せる"""
+    news = make_msg("news <news@example.com>", subject="お知らせ")
+    news["Message-ID"] = "<n1@example.com>"
+    friend = make_msg("friend <friend@example.com>", subject="こんにちは")
+    friend["Message-ID"] = "<f1@example.com>"
+    saved = check_mail.ARCHIVE_FOLDERS["notify"]
+    with isolated_state():
+        try:
+            check_mail.ARCHIVE_FOLDERS["notify"] = "Archive/{month}"
+            run_check_mail({1: friend.as_bytes()})
+            hit = check_mail.search_mail("こんにちは")[0]
+            assert hit["folder"].startswith("Archive/")
+            assert hit["message_id"] == "<f1@example.com>"
+
+            check_mail.ARCHIVE_FOLDERS["notify"] = None
+            run_check_mail({1: friend.as_bytes(), 2: news.as_bytes()})
+            assert check_mail.search_mail("お知らせ")[0]["folder"] == "INBOX"
+        finally:
+            check_mail.ARCHIVE_FOLDERS["notify"] = saved
+    print("✅ test_mail_index_records_archive_folder")
+
+
+# ─────────────────────────────────────────────
+# アーカイブ
+# ─────────────────────────────────────────────
+class FakeArchiveIMAP:
+    """アーカイブ用の IMAP コマンドを記録するだけのダミー"""
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.calls = []
+
+    def capability(self):
+        return "OK", [self.capabilities.encode()]
+
+    def create(self, folder):
+        self.calls.append(("CREATE", folder))
+        return "NO", [b"already exists"]
+
+    def uid(self, command, *args):
+        self.calls.append((command,) + args)
+        return "OK", [None]
+
+    def expunge(self):
+        self.calls.append(("EXPUNGE",))
+        return "OK", [None]
+
+
+def test_archive_folder():
+    """処理結果 → 月別フォルダ（INBOXに残す結果は None）"""
+    now = datetime(2026, 10, 19, tzinfo=check_mail.JST)
+    assert check_mail.archive_folder("notify", now) == "Archive/2026-10"
+    assert check_mail.archive_folder("auth_blocked", now) is None
+    assert check_mail.archive_folder("auto_process_failed", now) is None
+    print("✅ test_archive_folder")
+
+
+def test_archive_uid_move():
+    """MOVE 対応サーバー: UID範囲をまとめて1コマンドで移動"""
+    m = FakeArchiveIMAP("IMAP4rev1 MOVE UIDPLUS")
+    with isolated_state():
+        check_mail.archive_mails(m, {"Archive/2026-10": ["3", "1", "2", "7"]})
+        events = read_audit_events()
+    assert m.calls == [
+        ("CREATE", "Archive/2026-10"),
+        ("MOVE", "1:3,7", "Archive/2026-10"),
+    ]
+    assert [e["event"] for e in events] == ["mail_archived"]
+    print("✅ test_archive_uid_move")
+
+
+def test_archive_copy_fallback():
+    """MOVE 非対応: COPY + STORE \\Deleted + UID EXPUNGE"""
+    m = FakeArchiveIMAP("IMAP4rev1 UIDPLUS")
+    with isolated_state():
+        check_mail.archive_mails(m, {"Archive/2026-10": ["4", "5"]})
+    assert [c[0] for c in m.calls] == ["CREATE", "COPY", "STORE", "EXPUNGE"]
+    assert m.calls[-1] == ("EXPUNGE", "4:5")
+    print("✅ test_archive_copy_fallback")
+
+
+# ─────────────────────────────────────────────
+# 監査ログ集計
+# ─────────────────────────────────────────────
+def test_audit_stats_incremental():
+    """追記分だけを集計し、ローテート後は先頭から読み直す"""
+    with isolated_state():
+        check_mail.audit_log("mail_received", sender="a@example.com")
+        check_mail.audit_log("mail_blocked", sender="a@example.com",
+                             reason="SPF+DKIM両方失敗: mx.hetemail.jp; dkim=fail")
+        check_mail.audit_log("mail_processed", sender="b@example.com",
+                             action="system_event", success=True, latency_ms=800)
+        rollups = check_mail.update_audit_stats()
+        assert rollups["events"] == {"mail_received": 1, "mail_blocked": 1, "mail_processed": 1}
+        assert rollups["block_reasons"] == {"SPF+DKIM両方失敗": 1}
+        assert rollups["wake_latency_ms"] == {"<=1000": 1}
+
+        # 書き込み途中の行は次回に回す
+        with open(check_mail.AUDIT_LOG, "a") as f:
+            f.write(json.dumps({"event": "mail_processed", "action": "system_event",
+                                "success": False}) + "\n")
+            f.write('{"event": "mail_rec')
+        rollups = check_mail.update_audit_stats()
+        assert rollups["wake"] == {"success": 1, "failure": 1}
+        assert rollups["events"]["mail_received"] == 1
+
+        # ローテート: 新しいファイルの先頭から集計を続ける
+        check_mail.AUDIT_LOG.rename(check_mail.AUDIT_LOG.with_suffix(".jsonl.1"))
+        check_mail.audit_log("mail_received", sender="a@example.com")
+        rollups = check_mail.update_audit_stats()
+        assert rollups["events"]["mail_received"] == 2
+        report = check_mail.format_audit_report(rollups)
+        assert "50.0%" in report
+    print("✅ test_audit_stats_incremental")
+
+
+# ─────────────────────────────────────────────
+# 再送キュー
+# ─────────────────────────────────────────────
+def test_retry_delay_backoff():
+    """指数バックオフ: 基準値の半分〜等倍、上限で頭打ち"""
+    base = check_mail.RETRY_BASE_DELAY
+    for attempts in (1, 2, 3):
+        delay = check_mail.retry_delay(attempts)
+        expected = base * 2 ** (attempts - 1)
+        assert expected / 2 <= delay <= expected
+    assert check_mail.retry_delay(50) <= check_mail.RETRY_MAX_DELAY
+    print("✅ test_retry_delay_backoff")
+
+
+def test_outbox_retry_and_dead_letter():
+    """失敗した送信を再送し、上限に達したら dead letter に移す"""
+    with isolated_state() as (tmp, sent):
+        check_mail.wake_akiko = lambda text: sent.append(text) or True
+        check_mail.send_telegram = lambda text: check_mail.SEND_RETRY
+        check_mail.enqueue_outbound("system_event", "task", uid="10", subject="投稿")
+        check_mail.enqueue_outbound("telegram", "hello")
+        assert len(list(check_mail.OUTBOX_DIR.glob("*.json"))) == 2
+
+        # 期限前は再送しない
+        assert check_mail.drain_outbox() == 0
+        # 期限後: system event は成功、Telegram は失敗して残る
+        later = time.time() + check_mail.RETRY_MAX_DELAY * 2
+        assert check_mail.drain_outbox(now=later) == 1
+        assert sent == ["task"]
+        jobs = list(check_mail.OUTBOX_DIR.glob("*.json"))
+        assert len(jobs) == 1
+        assert json.loads(jobs[0].read_text())["attempts"] == 2
+
+        for _ in range(check_mail.RETRY_MAX_ATTEMPTS):
+            check_mail.drain_outbox(now=later + check_mail.RETRY_MAX_DELAY * 100)
+        assert list(check_mail.OUTBOX_DIR.glob("*.json")) == []
+        assert len(list((check_mail.OUTBOX_DIR / "dead").glob("*.json"))) == 1
+
+        events = [e["event"] for e in read_audit_events()]
+        assert events.count("outbound_queued") == 2
+        assert events.count("outbound_delivered") == 1
+        assert events.count("outbound_dead_letter") == 1
+    print("✅ test_outbox_retry_and_dead_letter")
+
+
+def test_telegram_permanent_failure_dead_letters():
+    """429 以外の 4xx は再送せず即 dead letter、5xx・429 は再送"""
+    import io, urllib.request, urllib.error
+    real_send = check_mail.send_telegram
+    saved_urlopen = urllib.request.urlopen
+    codes = []
+
+    def urlopen(request, timeout=None):
+        raise urllib.error.HTTPError(request.full_url, codes[-1], "error", {}, io.BytesIO())
+
+    with isolated_state() as (tmp, sent):
+        saved_config = check_mail.OPENCLAW_CONFIG
+        check_mail.OPENCLAW_CONFIG = tmp / "openclaw.json"
+        check_mail.OPENCLAW_CONFIG.write_text(
+            json.dumps({"channels": {"telegram": {"botToken": "x"}}}))
+        check_mail.send_telegram = real_send
+        urllib.request.urlopen = urlopen
+        try:
+            for code, expected in [(400, check_mail.SEND_PERMANENT),
+                                   (429, check_mail.SEND_RETRY),
+                                   (502, check_mail.SEND_RETRY)]:
+                codes.append(code)
+                assert check_mail.send_telegram("<b>x</b>") == expected, code
+
+            codes.append(400)
+            check_mail.telegram_notify("<broken>")
+            assert list(check_mail.OUTBOX_DIR.glob("*.json")) == []
+            assert len(list((check_mail.OUTBOX_DIR / "dead").glob("*.json"))) == 1
+            dead = [e for e in read_audit_events() if e["event"] == "outbound_dead_letter"]
+            assert dead[0]["reason"] == "permanent"
+        finally:
+            urllib.request.urlopen = saved_urlopen
+            check_mail.OPENCLAW_CONFIG = saved_config
+    print("✅ test_telegram_permanent_failure_dead_letters")
+
+
+def test_failed_wake_retry_task_keeps_expunge_rule():
+    """自動処理に失敗したメールは INBOX に残るので、再送タスクは削除を指示する"""
+    vip = make_msg(
+        "goodsun <goodsun0317@gmail.com>", subject="投稿お願い",
+        auth_results="mx.hetemail.jp;\n\tdkim=pass;\n\tspf=pass;\n\tdmarc=pass",
+    )
+    check_mail.AUTO_PROCESS_SENDERS = ["goodsun0317@gmail.com"]
+    try:
+        with isolated_state() as (tmp, sent):
+            def failing_wake(text):
+                sent.append(("system_event", text))
+                return False
+
+            check_mail.wake_akiko = failing_wake
+            mailbox = run_check_mail({1: vip.as_bytes()})
+            first = [text for kind, text in sent if kind == "system_event"][0]
+            assert "アーカイブされるため" in first
+
+            job = json.loads(next(check_mail.OUTBOX_DIR.glob("*.json")).read_text())
+            assert "削除（Expunge）すること" in job["text"]
+            assert not any(c[0] == "MOVE" for c in mailbox.calls)
+    finally:
+        check_mail.AUTO_PROCESS_SENDERS = []
+    print("✅ test_failed_wake_retry_task_keeps_expunge_rule")
+
+
+# ─────────────────────────────────────────────
+# 重複メール除外
+# ─────────────────────────────────────────────
+def test_dedup_key():
+    """Message-ID 優先、なければ正規化したヘッダ指紋"""
+    a = make_msg("goodsun <goodsun0317@gmail.com>", subject="投稿  お願い")
+    a["Message-ID"] = "<ABC@mail.gmail.com>"
+    b = make_msg("other <other@example.com>", subject="別件")
+    b["Message-ID"] = " <abc@mail.gmail.com>"
+    assert check_mail.dedup_key(a) == check_mail.dedup_key(b) == "mid:abc@mail.gmail.com"
+
+    c = make_msg("goodsun <goodsun0317@gmail.com>", subject="投稿  お願い")
+    c["Date"] = "Mon, 19 Oct 2026 10:00:00 +0900"
+    d = make_msg("Goodsun <GOODSUN0317@gmail.com>", subject="投稿 お願い")
+    d["Date"] = "Mon, 19 Oct 2026 01:00:00 +0000"
+    assert check_mail.dedup_key(c) == check_mail.dedup_key(d)
+    assert check_mail.dedup_key(c).startswith("fp:")
+    print("✅ test_dedup_key")
+
+
+def test_dedup_filter_persist_and_rotate():
+    """保存・復元後も判定でき、世代交代で古いキーは忘れる"""
+    saved = check_mail.DEDUP_RECENT_WINDOW, check_mail.DEDUP_BLOOM_CAPACITY
+    check_mail.DEDUP_RECENT_WINDOW, check_mail.DEDUP_BLOOM_CAPACITY = 3, 10
+    try:
+        with isolated_state():
+            path = check_mail.DEDUP_FILE
+            f = check_mail.DedupFilter()
+            f.add("mid:first@example.com")
+            f.save(path)
+            size = path.stat().st_size
+
+            f = check_mail.DedupFilter.load(path)
+            assert "mid:first@example.com" in f
+            assert "mid:other@example.com" not in f
+
+            # 直近集合から外れても Bloom フィルタで判定できる
+            for i in range(5):
+                f.add(f"mid:{i}@example.com")
+            assert "mid:first@example.com" in f
+            # 2世代分を超えると忘れる（メモリ・ファイルサイズは一定）
+            for i in range(25):
+                f.add(f"mid:more{i}@example.com")
+            assert "mid:first@example.com" not in f
+            f.save(path)
+            assert path.stat().st_size == size + 2 * 16
+    finally:
+        check_mail.DEDUP_RECENT_WINDOW, check_mail.DEDUP_BLOOM_CAPACITY = saved
+    print("✅ test_dedup_filter_persist_and_rotate")
+
+
+def test_failed_copy_does_not_suppress_genuine():
+    """認証NGで先に届いたコピーがあっても、正規のコピーは処理される"""
+    relayed = make_msg(
+        "goodsun <goodsun0317@gmail.com>", subject="投稿お願い",
+        auth_results=("mx.hetemail.jp;\n\tdkim=fail;\n"
+                      "\tdmarc=fail header.from=gmail.com (policy=reject);\n\tspf=fail"),
+    )
+    relayed["List-Id"] = "<friends.example.com>"
+    direct = make_msg(
+        "goodsun <goodsun0317@gmail.com>", subject="投稿お願い",
+        auth_results="mx.hetemail.jp;\n\tdkim=pass;\n\tspf=pass;\n\tdmarc=pass",
+    )
+    for msg in (relayed, direct):
+        msg["Message-ID"] = "<post-1@gmail.com>"
+    check_mail.AUTO_PROCESS_SENDERS = ["goodsun0317@gmail.com"]
+    try:
+        with isolated_state() as (tmp, sent):
+            # 同じ実行内の2通目の正規コピーは重複として落とす
+            run_check_mail({1: relayed.as_bytes(), 2: direct.as_bytes(), 3: direct.as_bytes()})
+            assert len([kind for kind, _ in sent if kind == "system_event"]) == 1
+            events = read_audit_events()
+            assert [e["uid"] for e in events if e["event"] == "mail_blocked"] == ["1"]
+            assert [e["uid"] for e in events if e["event"] == "mail_processed"] == ["2"]
+            assert [e["uid"] for e in events if e["event"] == "mail_duplicate"] == ["3"]
+    finally:
+        check_mail.AUTO_PROCESS_SENDERS = []
+    print("✅ test_failed_copy_does_not_suppress_genuine")
+
+
+# ─────────────────────────────────────────────
+# パイプライン
+# ─────────────────────────────────────────────
+def test_pipeline_order_and_errors():
+    """処理順は保たれ、途中のエラーは後段を飛ばして finish に届く"""
+    seen = []
+
+    def parse(item):
+        if item["uid"] == b"2":
+            raise ValueError("broken mime")
+        item["parsed"] = True
+
+    def dispatch(item):
+        seen.append(item["uid"])
+
+    finished = []
+    items = [{"uid": str(i).encode()} for i in range(1, 21)]
+    check_mail.run_pipeline(items, [lambda item: None, parse, dispatch], finished.append)
+    assert [i["uid"] for i in finished] == [str(i).encode() for i in range(1, 21)]
+    assert b"2" not in seen and len(seen) == 19
+    assert isinstance(finished[1]["error"], ValueError)
+    print("✅ test_pipeline_order_and_errors")
+
+
+def test_pipeline_overlaps_stages():
+    """各ステージが重なって動き、合計ではなく最も遅いステージ程度で終わる"""
+    def slow(item):
+        time.sleep(0.02)
+
+    items = [{"uid": str(i).encode()} for i in range(10)]
+    started = time.monotonic()
+    check_mail.run_pipeline(items, [slow, slow, slow], lambda item: None)
+    elapsed = time.monotonic() - started
+    assert elapsed < 10 * 3 * 0.02 * 0.7, f"stages did not overlap: {elapsed:.2f}s"
+    print("✅ test_pipeline_overlaps_stages")
+
+
+# ─────────────────────────────────────────────
+# 壊れたヘッダ
+# ─────────────────────────────────────────────
+def test_decode_header_lenient():
+    """不正なバイト列・未知の文字コードでも例外にしない"""
+    assert check_mail.decode_header_value("=?utf-8?b?gA==?=") == "\ufffd"
+    assert check_mail.decode_header_value("=?x-bogus?q?a?=") == "a"
+    print("✅ test_decode_header_lenient")
+
+
+def test_bogus_charset_does_not_block_run():
+    """未知の文字コードの To で実行全体が止まらない（重複判定は素通し）"""
+    bad = make_msg("friend <friend@example.com>", subject="bad").as_bytes()
+    bad = bad.replace(b"To: agent@example.com", b"To: =?x-bogus?q?a?=")
+    good = make_msg("friend <friend@example.com>", subject="hello").as_bytes()
+    with isolated_state() as (tmp, sent):
+        run_check_mail({1: bad, 2: good})
+        assert check_mail.STATE_FILE.read_text() == "2"
+        texts = [text for kind, text in sent]
+        assert any("bad" in t for t in texts) and any("hello" in t for t in texts)
+        assert "check_mail_error" not in [e["event"] for e in read_audit_events()]
+    print("✅ test_bogus_charset_does_not_block_run")
+
+
+def test_undecodable_from_does_not_block_run():
+    """デコードできない From の1通で実行全体が止まらない"""
+    bad = make_msg("friend@example.com", subject="bad").as_bytes()
+    bad = bad.replace(b"From: friend@example.com", b"From: =?utf-8?b?gA==?=")
+    good = make_msg("friend <friend@example.com>", subject="hello").as_bytes()
+    with isolated_state() as (tmp, sent):
+        run_check_mail({1: bad, 2: good})
+        assert check_mail.STATE_FILE.read_text() == "2"
+        assert any("hello" in text for kind, text in sent)
+        assert "check_mail_error" not in [e["event"] for e in read_audit_events()]
+    print("✅ test_undecodable_from_does_not_block_run")
+
+
+def test_classify_error_skips_only_that_mail():
+    """分類中の例外は mail_error として該当UIDだけ飛ばす"""
+    saved = check_mail.record_sender
+
+    def record_sender(stats, sender_email, bulk_reason):
+        if sender_email == "bad@example.com":
+            raise UnicodeDecodeError("utf-8", b"\x80", 0, 1, "invalid start byte")
+        saved(stats, sender_email, bulk_reason)
+
+    check_mail.record_sender = record_sender
+    try:
+        with isolated_state() as (tmp, sent):
+            run_check_mail({
+                1: make_msg("bad <bad@example.com>", subject="bad").as_bytes(),
+                2: make_msg("friend <friend@example.com>", subject="hello").as_bytes(),
+            })
+            assert check_mail.STATE_FILE.read_text() == "2"
+            events = read_audit_events()
+            assert [e["uid"] for e in events if e["event"] == "mail_error"] == ["1"]
+            assert any("hello" in text for kind, text in sent)
+    finally:
+        check_mail.record_sender = saved
+    print("✅ test_classify_error_skips_only_that_mail")
+
+
 # ─────────────────────────────────────────────
 # 実行
 # ─────────────────────────────────────────────
@@ -289,6 +1055,46 @@ if __name__ == "__main__":
         # 本文サニタイズ
         test_body_truncation,
         test_body_normal,
+        # 優先度レーン
+        test_uid_ranges,
+        test_classify_lanes,
+        test_fetch_headers_batch,
+        test_watermark_out_of_order,
+        test_completed_uids_survive_crash,
+        # 一括配信メール
+        test_detect_bulk_headers,
+        test_detect_bulk_reputation,
+        test_vip_never_digested,
+        test_bulk_digest_format,
+        test_bulk_digest_escapes_html,
+        test_bulk_digest_interval_flushes_without_new_mail,
+        # 全文検索インデックス
+        test_mail_index_search,
+        test_mail_index_search_short_terms,
+        test_mail_index_records_archive_folder,
+        # アーカイブ
+        test_archive_folder,
+        test_archive_uid_move,
+        test_archive_copy_fallback,
+        # 監査ログ集計
+        test_audit_stats_incremental,
+        # 再送キュー
+        test_retry_delay_backoff,
+        test_outbox_retry_and_dead_letter,
+        test_telegram_permanent_failure_dead_letters,
+        test_failed_wake_retry_task_keeps_expunge_rule,
+        # 重複メール除外
+        test_dedup_key,
+        test_dedup_filter_persist_and_rotate,
+        test_failed_copy_does_not_suppress_genuine,
+        # パイプライン
+        test_pipeline_order_and_errors,
+        test_pipeline_overlaps_stages,
+        # 壊れたヘッダ
+        test_decode_header_lenient,
+        test_bogus_charset_does_not_block_run,
+        test_undecodable_from_does_not_block_run,
+        test_classify_error_skips_only_that_mail,
     ]
 
     passed = 0